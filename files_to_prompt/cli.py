@@ -1,15 +1,65 @@
+import codecs
+import contextlib
+import functools
+import heapq
+import io
+import itertools
+import math
 import os
+import re
+import stat
 import sys
 import sqlite3
-from fnmatch import fnmatch
-from files_to_prompt.utils import allowed_by_gitignore
+from fnmatch import translate
+from files_to_prompt.utils import load_gitignore_spec, matches_gitignores
 import pathlib
 import click
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import tiktoken
-from typing import Dict
+from dataclasses import dataclass, field
+from typing import Dict, List, Set, Tuple
 
-global_index = 1
-processed_paths = set()
+# File reads are I/O bound, so use more threads than cores to overlap latency
+MAX_READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Maximum number of file reads queued ahead of the output
+READ_AHEAD = MAX_READ_WORKERS * 2
+
+# Magic header at the start of every SQLite3 database file
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# Queued file contents are token-counted in batches of about this many characters
+STATS_BATCH_CHARS = 4 * 1024 * 1024
+
+# With --fast-stats, files larger than this are always token-counted exactly
+FAST_STATS_SAMPLE_SIZE = 64 * 1024
+
+# Paths piped to stdin with --null are read in chunks of this many characters
+STDIN_CHUNK_SIZE = 64 * 1024
+
+# Output is written in chunks of this size instead of line by line
+OUTPUT_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Closes every document in the output
+DOCUMENT_FOOTER = "\n</document>\n"
+
+# Files larger than this are copied to the output in chunks of this size
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Returned by read_file() in place of the content of files over --max-file-size
+TOO_LARGE = object()
+
+# Characters that make an ignore pattern a glob rather than a literal name
+GLOB_CHARS = re.compile(r"[*?[]")
+
+# Number of bytes at the start of a file that is_binary_file() inspects
+BINARY_SNIFF_SIZE = 1024
+
+# read_file() starts with a read of this many bytes, one page, which is
+# enough for the SQLite and binary checks and holds many files entirely
+PROBE_SIZE = 4096
+ASCII_BYTES = bytes(range(128))
 
 # List of binary file extensions to skip by default
 BINARY_FILE_EXTENSIONS = (
@@ -29,31 +79,59 @@ BINARY_FILE_EXTENSIONS = (
     ".log",
 )
 
+@functools.lru_cache(maxsize=8)
+def get_encoding(encoding_name):
+    """Load a tiktoken encoding once per process and share it between trackers."""
+    return tiktoken.get_encoding(encoding_name)
+
 class StatsTracker:
-    """Track file statistics, including token counts using tiktoken."""
-    def __init__(self, encoding_name="cl100k_base", target_path=None):
-        self.encoding = tiktoken.get_encoding(encoding_name)
+    """Track file statistics, including token counts using tiktoken.
+
+    Token counting is deferred: files are queued by add_file() and encoded in
+    batches, so call finalize() before reading token counts. print_tree()
+    does this itself.
+
+    With fast=True only a sample of roughly sqrt(N) files, plus every large
+    file, is encoded. The token counts of the rest are estimated from their
+    length using the tokens-per-character ratio of the sample.
+    """
+    def __init__(self, encoding_name="cl100k_base", target_path=None, fast=False):
+        self.encoding = get_encoding(encoding_name)
+        self.fast = fast
         self.files: Dict[str, Dict] = {}
         self.total_tokens = 0
         self.total_files = 0
         self.total_processed = 0
         self.target_path = target_path
+        # Paths below target_path start with this, so they can be made
+        # relative by slicing instead of calling os.path.relpath()
+        self.target_str = str(target_path) if target_path else ""
+        self.target_prefix = os.path.join(self.target_str, "") if target_path else ""
+        # Files waiting to be encoded, as (key into self.files, content) pairs
+        self.pending: List[Tuple[str, str]] = []
+        self.pending_chars = 0
+        # Fast mode: totals over the encoded sample, and the files left to estimate
+        self.sampled_chars = 0
+        self.sampled_tokens = 0
+        self.estimated: List[str] = []
 
-    def add_file(self, file_path: str, content: str, processed: bool = True):
-        tokens = self.encoding.encode(content)
-        token_count = len(tokens)
-        
-        # Only add processed files to total tokens count
-        if processed:
-            self.total_tokens += token_count
-        
-        # If target_path is set, make the path relative to it
-        if self.target_path and str(file_path).startswith(str(self.target_path)):
-            # Create a relative path from the target_path
-            rel_path = os.path.relpath(file_path, self.target_path)
+    def relative_to_target(self, path):
+        """Return path relative to target_path with a "./" prefix, or None if it isn't below it."""
+        if self.target_prefix and path.startswith(self.target_prefix):
+            return './' + path[len(self.target_prefix):]
+        if self.target_str and path.startswith(self.target_str):
+            # Rare cases like the target itself, or a sibling sharing its prefix
+            rel_path = os.path.relpath(path, self.target_path)
             # Ensure path starts with ./ for consistency
             if not rel_path.startswith('./') and not rel_path.startswith('/'):
                 rel_path = './' + rel_path
+            return rel_path
+        return None
+
+    def add_file(self, file_path: str, content: str, processed: bool = True):
+        # If target_path is set, make the path relative to it
+        rel_path = self.relative_to_target(file_path)
+        if rel_path is not None:
             parts = rel_path.split('/')
         else:
             # Handle absolute paths or paths not under target_path
@@ -65,80 +143,142 @@ class StatsTracker:
         if processed:
             self.files[file_path] = {
                 'size': len(content),
-                'tokens': token_count,
+                'tokens': 0,  # Filled in once the file has been encoded
                 'processed': processed,
                 'parts': parts
             }
+            if self.fast and not self.should_sample(len(content)):
+                self.estimated.append(file_path)
+            else:
+                self.pending.append((file_path, content))
+                self.pending_chars += len(content)
+                # Bound how much content is held in memory waiting to be encoded
+                if self.pending_chars >= STATS_BATCH_CHARS:
+                    self.encode_pending()
         
         self.total_files += 1
         if processed:
             self.total_processed += 1
 
+    def should_sample(self, size: int) -> bool:
+        """Decide whether the next processed file is encoded in fast mode.
+
+        The n-th file is sampled when n is a perfect square, which picks about
+        sqrt(N) of N files without knowing N in advance. Large files dominate
+        the total, so they are always encoded exactly.
+        """
+        n = self.total_processed + 1
+        return size > FAST_STATS_SAMPLE_SIZE or math.isqrt(n) ** 2 == n
+
+    def encode_pending(self):
+        """Encode the queued files and update their token counts."""
+        if not self.pending:
+            return
+        # tiktoken spreads a batch over its own thread pool, and its encoder
+        # releases the GIL while it works. File contents are plain text, so
+        # skip the scan for special tokens like <|endoftext|>, which encode()
+        # would also reject with a ValueError.
+        encoded = self.encoding.encode_ordinary_batch(
+            [content for _, content in self.pending], num_threads=os.cpu_count() or 1
+        )
+        for (file_path, _), tokens in zip(self.pending, encoded):
+            # Only processed files are queued, so all of them count towards the total
+            self.files[file_path]['tokens'] = len(tokens)
+            self.total_tokens += len(tokens)
+            self.sampled_tokens += len(tokens)
+        self.sampled_chars += self.pending_chars
+        self.pending = []
+        self.pending_chars = 0
+
+    def finalize(self):
+        """Encode all queued files and estimate the token counts of unsampled ones."""
+        self.encode_pending()
+        if not self.estimated:
+            return
+        ratio = self.sampled_tokens / max(1, self.sampled_chars)
+        for file_path in self.estimated:
+            tokens = round(self.files[file_path]['size'] * ratio)
+            self.files[file_path]['tokens'] = tokens
+            self.total_tokens += tokens
+        self.estimated = []
+
     def get_top_files_by_tokens(self, n=10):
         """Get the top N files with the most tokens."""
-        # Filter for processed files only and sort by token count (descending)
-        sorted_files = sorted(
-            [(path, data) for path, data in self.files.items() if data['processed']],
+        self.finalize()
+        # Filter for processed files only and pick the n largest by token count,
+        # without sorting all of them
+        return heapq.nlargest(
+            n,
+            ((path, data) for path, data in self.files.items() if data['processed']),
             key=lambda x: x[1]['tokens'],
-            reverse=True
         )
-        return sorted_files[:n]
     
     def get_tree_structure(self):
-        """Build a tree structure of files and directories with token counts."""
-        tree = {}
+        """Build a tree structure of files and directories with token counts.
+
+        Returns a mapping from each top-level name to its node. Nodes hold
+        their counts plus a 'children' mapping of the same shape; file nodes
+        also carry 'file_info'.
+        """
+        # Aggregate the counts of every directory and file in a flat mapping
+        # keyed by path prefix, then nest the nodes once at the end
+        counts = defaultdict(lambda: [0, 0, 0])  # files, tokens, processed
+        leaves = {}
         
         # Only include processed files in the tree structure
-        for path, data in self.files.items():
+        for data in self.files.values():
             # Skip unprocessed files (binary files)
             if not data['processed']:
                 continue
                 
-            parts = data['parts']
-            current = tree
-            
-            # Navigate through the tree
-            for i, part in enumerate(parts[:-1]):
-                if part not in current:
-                    current[part] = {'__files': 0, '__tokens': 0, '__processed': 0}
-                
-                # Update counts at each level
-                current[part]['__files'] += 1
-                current[part]['__tokens'] += data['tokens']
-                if data['processed']:
-                    current[part]['__processed'] += 1
-                    
-                current = current[part]
-            
-            # Add the file at the leaf level
-            leaf = parts[-1]
-            if leaf not in current:
-                current[leaf] = {
-                    '__files': 1,
-                    '__tokens': data['tokens'],
-                    '__processed': 1 if data['processed'] else 0,
-                    '__is_file': True,
-                    '__file_info': {
-                        'size': data['size'],
-                        'tokens': data['tokens'],
-                        'processed': data['processed']
-                    }
+            parts = tuple(data['parts'])
+            tokens = data['tokens']
+            for i in range(1, len(parts) + 1):
+                prefix_counts = counts[parts[:i]]
+                prefix_counts[0] += 1
+                prefix_counts[1] += tokens
+                prefix_counts[2] += 1
+            leaves.setdefault(parts, data)
+        
+        tree = {}
+        # Maps each prefix to the children of its node
+        children = {(): tree}
+        # Shorter prefixes first, so every parent exists before its children
+        for prefix in sorted(counts, key=len):
+            files, tokens, processed = counts[prefix]
+            data = leaves.get(prefix)
+            node = {
+                'files': files,
+                'tokens': tokens,
+                'processed': processed,
+                'is_file': data is not None,
+                # Files are listed before directories, then by name
+                'sort_key': (0 if data is not None else 1, prefix[-1]),
+                'children': {},
+            }
+            if data is not None:
+                node['file_info'] = {
+                    'size': data['size'],
+                    'tokens': data['tokens'],
+                    'processed': data['processed']
                 }
-            else:
-                current[leaf]['__files'] += 1
-                current[leaf]['__tokens'] += data['tokens']
-                if data['processed']:
-                    current[leaf]['__processed'] += 1
+            children[prefix[:-1]][prefix[-1]] = node
+            children[prefix] = node['children']
         
         return tree
     
     def print_tree(self, writer=print):
         """Print the file tree with token statistics."""
+        self.finalize()
         tree = self.get_tree_structure()
         
         # Only output the processed files count
         writer(f"Processed files: {self.total_processed}")
         
+        def sorted_children(data):
+            """List the (name, node) children of a node in display order."""
+            return sorted(data['children'].items(), key=lambda x: x[1]['sort_key'])
+        
         def print_node(node, prefix="", is_last=True, depth=0):
             # Get node name and data
             name, data = node
@@ -146,26 +286,25 @@ class StatsTracker:
             # Handle the root node differently - print without branch characters
             if depth == 0:
                 # Print stats for root
-                tokens_count = data['__tokens']
+                tokens_count = data['tokens']
                 writer(f"{name} [{tokens_count} tokens]")
             else:  
                 # For non-root nodes, use branch characters
                 branch = "└─ " if is_last else "├─ "
                 
                 # Print stats for directories or files
-                if not data.get('__is_file', False):
-                    tokens_count = data['__tokens']
+                if not data['is_file']:
+                    tokens_count = data['tokens']
                     writer(f"{prefix}{branch}{name} [{tokens_count} tokens]")
                 else:
-                    info = data['__file_info']
+                    info = data['file_info']
                     writer(f"{prefix}{branch}{name} [{info['tokens']} tokens]")
             
             # Calculate prefix for children
             next_prefix = prefix + ("    " if is_last else "│   ")
             
             # Get and sort children items
-            items = [(k, v) for k, v in data.items() if not k.startswith('__')]
-            items.sort(key=lambda x: (0 if x[1].get('__is_file', False) else 1, x[0]))
+            items = sorted_children(data)
             
             # Process children
             for i, item in enumerate(items):
@@ -175,33 +314,31 @@ class StatsTracker:
         root_items = [(k, v) for k, v in tree.items()]
         if root_items:
             # Sort root items
-            root_items.sort(key=lambda x: (0 if x[1].get('__is_file', False) else 1, x[0]))
+            root_items.sort(key=lambda x: x[1]['sort_key'])
             
             # Print the root node directly without any indentation or branch characters
             if len(root_items) == 1:  # Usually we only have one root node
                 name, data = root_items[0]
-                tokens_count = data['__tokens']
+                tokens_count = data['tokens']
                 writer(f"{name} [{tokens_count} tokens]")
                 
                 # Process children of the root with proper indentation
-                items = [(k, v) for k, v in data.items() if not k.startswith('__')]
-                items.sort(key=lambda x: (0 if x[1].get('__is_file', False) else 1, x[0]))
+                items = sorted_children(data)
                 
                 for i, item in enumerate(items):
                     is_last = i == len(items) - 1
                     branch = "└─ " if is_last else "├─ "
                     name, data = item
                     
-                    if data.get('__is_file', False):
-                        info = data['__file_info']
+                    if data['is_file']:
+                        info = data['file_info']
                         writer(f"{branch}{name} [{info['tokens']} tokens]")
                     else:
-                        writer(f"{branch}{name} [{data['__tokens']} tokens]")
+                        writer(f"{branch}{name} [{data['tokens']} tokens]")
                     
                     # Process further children with regular print_node
                     next_prefix = "    " if is_last else "│   "
-                    subitems = [(k, v) for k, v in data.items() if not k.startswith('__')]
-                    subitems.sort(key=lambda x: (0 if x[1].get('__is_file', False) else 1, x[0]))
+                    subitems = sorted_children(data)
                     
                     for j, subitem in enumerate(subitems):
                         print_node(subitem, next_prefix, j == len(subitems) - 1, depth=2)
@@ -217,25 +354,16 @@ class StatsTracker:
             writer("\nTop 10 files by token count:")
             for i, (path, data) in enumerate(top_files, 1):
                 # Get the relative path if available
-                display_path = path
-                if self.target_path and str(path).startswith(str(self.target_path)):
-                    display_path = os.path.relpath(path, self.target_path)
-                    if not display_path.startswith('./') and not display_path.startswith('/'):
-                        display_path = './' + display_path
-                        
+                display_path = self.relative_to_target(path) or path
                 writer(f"{i}. {display_path} [{data['tokens']} tokens]")
 
 def add_line_numbers(content):
     lines = content.splitlines()
-    padding = len(str(len(lines)))
-    numbered_lines = [f"{i + 1:{padding}}  {line}" for i, line in enumerate(lines)]
-    return "\n".join(numbered_lines)
+    # Build the format once instead of re-parsing the width spec for every line
+    line_format = f"%{len(str(len(lines)))}d  %s"
+    return "\n".join([line_format % numbered for numbered in enumerate(lines, 1)])
 
-def print_document(writer, path, content, line_numbers, root_path=None):
-    global global_index
-    if line_numbers:
-        content = add_line_numbers(content)
-        
+def document_header(path, index, root_path=None):
     # If root_path is provided, make the path relative to it
     display_path = path
     if root_path:
@@ -249,92 +377,317 @@ def print_document(writer, path, content, line_numbers, root_path=None):
             # Avoid showing './' prefix for files directly in the root
             display_path = rel_path
         
-    writer(f'<document path="{display_path}" index="{global_index}">')
-    writer(content)
-    writer("</document>")
-    global_index += 1
+    return f'<document path="{display_path}" index="{index}">\n'
+
+def print_document(writer, path, content, line_numbers, index, root_path=None):
+    if line_numbers:
+        content = add_line_numbers(content)
+    # Hand the whole document to the writer in one call rather than three
+    writer(f"{document_header(path, index, root_path)}{content}{DOCUMENT_FOOTER}")
+
+@dataclass
+class StreamedFile:
+    """A large file that read_file() left open for stream_document() to copy."""
+    # The file, opened in binary mode and positioned after the part already read
+    file: io.RawIOBase
+    # The UTF-8 decoder that part went through, and the text it decoded to
+    decoder: codecs.IncrementalDecoder
+    head: str
 
-def is_sqlite3_file(file_path):
-    """Check if the given file is a SQLite3 database."""
+def stream_document(writer, path, streamed, index, root_path=None):
+    """Like print_document(), but copy a StreamedFile to the writer in chunks.
+
+    This keeps memory use flat for large files instead of holding the whole
+    content in memory at once. The file is decoded as it is copied, so it is
+    only read once, and closed afterwards.
+
+    Returns None, or the UnicodeDecodeError or OSError that cut the copy
+    short. The document is closed either way, after whatever part of the
+    file had already been written.
+    """
+    decoder = streamed.decoder
+    error = None
+    writer(document_header(path, index, root_path))
+    writer(streamed.head)
     try:
-        # Read the first 16 bytes to check for SQLite3 header
-        with open(file_path, "rb") as f:
-            header = f.read(16)
-        return header[:16].startswith(b'SQLite format 3')
-    except (IOError, OSError):
-        return False
+        with streamed.file as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                writer(decoder.decode(chunk))
+            writer(decoder.decode(b"", final=True))
+    except (UnicodeDecodeError, OSError) as e:
+        error = e
+    writer(DOCUMENT_FOOTER)
+    return error
 
 def get_sqlite_schema(file_path):
-    """Extract schema information from a SQLite3 database file."""
-    try:
-        conn = sqlite3.connect(file_path)
-        cursor = conn.cursor()
+    """Extract schema information from a SQLite3 database file.
 
-        # Get tables schema
-        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table' ORDER BY name")
-        tables = cursor.fetchall()
+    The database is opened read-only. Without a write-ahead log or rollback
+    journal beside it, it is also opened immutable, which skips locking;
+    otherwise changes that are still in the log would be missed.
+    """
+    try:
+        path = pathlib.Path(file_path).resolve()
+        uri = path.as_uri() + "?mode=ro"
+        if not any(os.path.exists(f"{path}{suffix}") for suffix in ("-wal", "-journal")):
+            uri += "&immutable=1"
+        conn = sqlite3.connect(uri, uri=True)
+        try:
+            conn.execute("PRAGMA query_only = 1")
+            conn.execute("PRAGMA mmap_size = 268435456")
 
-        # Get views schema
-        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='view' ORDER BY name")
-        views = cursor.fetchall()
+            # Fetch tables, views and indexes in a single pass over sqlite_master
+            rows = conn.execute(
+                "SELECT type, sql FROM sqlite_master "
+                "WHERE type IN ('table', 'view') "
+                "OR (type = 'index' AND name NOT LIKE 'sqlite_%') "
+                "ORDER BY name"
+            ).fetchall()
+        finally:
+            conn.close()
 
-        # Get indexes schema
-        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND name NOT LIKE 'sqlite_%' ORDER BY name")
-        indexes = cursor.fetchall()
+        schema = {"table": [], "view": [], "index": []}
+        for object_type, sql in rows:
+            schema[object_type].append(sql)
+        tables, views, indexes = schema["table"], schema["view"], schema["index"]
 
         # Format the results
         schema_parts = []
 
         if tables:
             schema_parts.append("-- Tables")
-            for table_name, table_sql in tables:
+            for table_sql in tables:
                 schema_parts.append(f"{table_sql};")
 
         if views:
             schema_parts.append("\n-- Views")
-            for view_name, view_sql in views:
+            for view_sql in views:
                 schema_parts.append(f"{view_sql};")
 
         if indexes:
             schema_parts.append("\n-- Indexes")
-            for idx_name, idx_sql in indexes:
+            for idx_sql in indexes:
                 schema_parts.append(f"{idx_sql};")
 
-        conn.close()
         return "\n".join(schema_parts)
 
     except sqlite3.Error as e:
         return f"Error extracting schema: {str(e)}"
 
-def is_binary_file(file_path):
-    """Check if a file is a known binary format based on extension."""
+def is_binary_file(file_path, chunk=None):
+    """Check if a file is binary, based on its extension or its first bytes.
+
+    chunk is the start of the file if the caller has already read it;
+    otherwise the first BINARY_SNIFF_SIZE bytes are read here.
+    """
     # Check against known binary extensions
-    file_lower = str(file_path).lower()
-    for ext in BINARY_FILE_EXTENSIONS:
-        if file_lower.endswith(ext):
-            return True
-    
-    # For unrecognized extensions, try to read the first chunk and check for nullbytes
-    # which is a common indicator of binary content
-    try:
-        with open(file_path, 'rb') as f:
-            chunk = f.read(1024)
-            # Binary files often contain null bytes
-            if b'\x00' in chunk:
-                return True
-            # ASCII files don't typically contain a high percentage of non-ASCII characters
-            non_ascii = sum(1 for b in chunk if b > 127)
-            if non_ascii > len(chunk) * 0.3:  # 30% of content is non-ASCII
-                return True
-    except (IOError, OSError):
-        # If we can't open the file, default to considering it binary
+    if str(file_path).lower().endswith(BINARY_FILE_EXTENSIONS):
         return True
     
+    if chunk is None:
+        try:
+            with open(file_path, 'rb') as f:
+                chunk = f.read(BINARY_SNIFF_SIZE)
+        except (IOError, OSError):
+            # If we can't open the file, default to considering it binary
+            return True
+    chunk = chunk[:BINARY_SNIFF_SIZE]
+    # Binary files often contain null bytes
+    if b'\x00' in chunk:
+        return True
+    # Most source files are pure ASCII, which bytes.isascii() confirms
+    # without building a copy
+    if chunk.isascii():
+        return False
+    # ASCII files don't typically contain a high percentage of non-ASCII characters.
+    # Deleting the ASCII bytes leaves just the non-ASCII ones to count.
+    non_ascii = len(chunk.translate(None, ASCII_BYTES))
+    return non_ascii > len(chunk) * 0.3  # 30% of content is non-ASCII
+
+def read_files(file_paths, extract_sqlite, stream=False, max_file_size=None):
+    """Read files on a thread pool, yielding (file_path, content, error) in order.
+
+    Up to READ_AHEAD reads are kept in flight so that disk latency overlaps,
+    while only a bounded window of file contents is held in memory at once.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_READ_WORKERS) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            future = executor.submit(read_file, file_path, extract_sqlite, stream, max_file_size)
+            pending.append((file_path, future))
+            if len(pending) >= READ_AHEAD:
+                file_path, future = pending.popleft()
+                yield (file_path, *future.result())
+        while pending:
+            file_path, future = pending.popleft()
+            yield (file_path, *future.result())
+
+class IgnorePatterns:
+    """Match entry names and paths against fnmatch-style ignore patterns.
+
+    Patterns containing a "/" are matched against the entry's path below the
+    walked directory, all other patterns against the entry name. The common
+    simple shapes skip the regex engine:
+
+    - patterns without wildcards (like "LICENSE") are looked up in a set
+    - "*suffix" patterns (like "*.log") become a single str.endswith() call
+    - "**/name" patterns (like "**/uv.lock") match that name anywhere below
+      the top of the walk, so they are a set lookup plus a check for a "/"
+
+    Everything else is compiled into one regular expression per group.
+    """
+    def __init__(self, patterns):
+        # fnmatch normalizes case on Windows, so matching has to as well
+        self.fold_case = os.name == "nt"
+        if self.fold_case:
+            patterns = [p.lower() for p in patterns]
+        name_patterns = []
+        path_patterns = []
+        suffixes = []
+        nested_names = []
+        for p in patterns:
+            if p.startswith("*") and not GLOB_CHARS.search(p[1:]) and "/" not in p:
+                suffixes.append(p[1:])
+            elif p.startswith("**/") and not GLOB_CHARS.search(p[3:]) and "/" not in p[3:]:
+                nested_names.append(p[3:])
+            elif "/" in p:
+                path_patterns.append(p)
+            else:
+                name_patterns.append(p)
+        self.suffixes = tuple(suffixes)
+        self.nested_names = frozenset(nested_names)
+        self.name_literals = frozenset(p for p in name_patterns if not GLOB_CHARS.search(p))
+        self.path_literals = frozenset(p for p in path_patterns if not GLOB_CHARS.search(p))
+        self.name_re = self.compile_globs(name_patterns)
+        self.path_re = self.compile_globs(path_patterns)
+
+    def compile_globs(self, patterns):
+        """Join the patterns that contain wildcards into one regex, or None if there are none."""
+        globs = [p for p in patterns if GLOB_CHARS.search(p)]
+        if not globs:
+            return None
+        flags = re.IGNORECASE if self.fold_case else 0
+        return re.compile("|".join(f"(?:{translate(p)})" for p in globs), flags)
+
+    def match(self, name, rel_path):
+        """Check whether the entry name or its relative path is ignored."""
+        if self.fold_case:
+            name, rel_path = name.lower(), rel_path.lower()
+        if (
+            name in self.name_literals
+            or rel_path in self.path_literals
+            or name.endswith(self.suffixes)
+            or (name in self.nested_names and "/" in rel_path)
+        ):
+            return True
+        return bool(
+            (self.name_re is not None and self.name_re.match(name))
+            or (self.path_re is not None and self.path_re.match(rel_path))
+        )
+
+def compile_ignore_patterns(patterns):
+    """Compile fnmatch-style ignore patterns into an IgnorePatterns matcher.
+
+    Returns None when there are no patterns, so callers can skip matching entirely.
+    """
+    if not patterns:
+        return None
+    return IgnorePatterns(patterns)
+
+def read_file(file_path, extract_sqlite, stream=False, max_file_size=None):
+    """Load the content to output for a single file.
+
+    Returns a (content, error) tuple. content is None when the file should be
+    skipped (binary, undecodable or unreadable); error is set when SQLite
+    schema extraction failed. This runs on worker threads, so it must not write any output itself.
+
+    Files are read as bytes and decoded as UTF-8 in one go, so line endings
+    are passed through unchanged. Files larger than max_file_size bytes are
+    not read at all and TOO_LARGE is returned in place of their content.
+
+    With stream=True, files larger than STREAM_CHUNK_SIZE are not read past
+    the probe. A StreamedFile holding the open file is returned in place of
+    their content, for the caller to copy to the output with stream_document(),
+    which closes it.
+    """
+    try:
+        with contextlib.ExitStack() as stack:
+            # Unbuffered, so every read below is a single read() call on the descriptor
+            f = stack.enter_context(open(file_path, "rb", buffering=0))
+            # Sniff the SQLite3 header and binary content from a single read.
+            # The header is exactly 16 bytes, so a plain equality check suffices.
+            head = f.read(PROBE_SIZE)
+            if extract_sqlite and head[:len(SQLITE_HEADER)] == SQLITE_HEADER:
+                try:
+                    schema = get_sqlite_schema(file_path)
+                    return f"-- SQLite3 Database Schema\n{schema}", None
+                except Exception as e:
+                    return None, e
+            if is_binary_file(file_path, head):
+                return None, None
+            # Most source files fit in the probe, in which case it holds the
+            # whole file and fstat isn't needed. A short read alone doesn't
+            # prove EOF (FUSE and network filesystems, files being appended
+            # to), so that takes a second read coming back empty.
+            complete = False
+            if len(head) < PROBE_SIZE:
+                more = f.read(PROBE_SIZE)
+                complete = not more
+                head += more
+            size = len(head) if complete else os.fstat(f.fileno()).st_size
+            if max_file_size is not None and size > max_file_size:
+                return TOO_LARGE, None
+            if stream and size > STREAM_CHUNK_SIZE:
+                # Files that aren't UTF-8 mostly show it early, so checking the
+                # probe skips them like smaller files instead of cutting them short
+                decoder = codecs.getincrementaldecoder("utf-8")()
+                try:
+                    text = decoder.decode(head)
+                except UnicodeDecodeError:
+                    return None, None
+                # Keep the file open, so it's only read once, by stream_document()
+                stack.pop_all()
+                return StreamedFile(f, decoder, text), None
+            try:
+                if complete:
+                    return head.decode("utf-8"), None
+                return (head + f.read()).decode("utf-8"), None
+            except UnicodeDecodeError:
+                return None, None
+    except OSError:
+        # Unreadable files, such as dangling symlinks, are skipped like
+        # binary ones
+        return None, None
+
+def compile_extensions(extensions):
+    """Normalize --extension values into a set of lowercase suffixes without dots.
+
+    Returns None when no extensions were given, meaning every file is included.
+    """
+    return frozenset(e.lstrip(".").lower() for e in extensions) or None
+
+def has_extension(name, ext_set):
+    """Check whether a file name ends in one of the suffixes in ext_set."""
+    name = name.lower()
+    # Try the suffix after each dot, so multi-part extensions like "tar.gz" work
+    i = name.find(".")
+    while i >= 0:
+        if name[i + 1:] in ext_set:
+            return True
+        i = name.find(".", i + 1)
     return False
 
+@dataclass
+class RunContext:
+    """State shared by every process_path() call of a single run."""
+    # Index of the next document to output
+    index: int = 1
+    # Normalized paths of the files already queued for output
+    seen: Set[str] = field(default_factory=set)
+
 def process_path(
     path,
-    extensions,
+    ext_set,
     include_hidden,
     ignore_files_only,
     ignore_gitignore,
@@ -345,98 +698,170 @@ def process_path(
     stats_tracker=None,
     root_path=None,
     stats_only=False,
+    context=None,
+    max_file_size=None,
 ):
     """Process a file or directory path, generating the document output.
     
     The path is resolved relative to the current working directory,
     which can be modified using the --cwd option in the CLI.
+
+    Files already seen in context are skipped, and newly processed files
+    are added to it. Documents are numbered from context.index onwards.
     """ 
-    all_files = [path] if os.path.isfile(path) else []
-    if os.path.isdir(path):
-        for root, dirs, files in os.walk(path):
-            if not include_hidden:
-                dirs[:] = [d for d in dirs if not d.startswith(".")]
-                files = [f for f in files if not f.startswith(".")]
-
-            root_path = pathlib.Path(root)
-            if not ignore_gitignore:
-                dirs[:] = [
-                    d for d in dirs if allowed_by_gitignore(root_path, root_path / d)
-                ]
-                files = [
-                    f for f in files if allowed_by_gitignore(root_path, root_path / f)
-                ]
-
-            if ignore_patterns:
-                if not ignore_files_only:
-                    filtered_dirs = []
-                    for d in dirs:
-                        # Get relative path from root_path
-                        rel_dir_path = os.path.relpath(os.path.join(root, d), path).replace('\\', '/')
-                        # Check if any pattern matches the dir name or path
-                        if not any(fnmatch(d, pattern) or fnmatch(rel_dir_path, pattern) for pattern in ignore_patterns):
-                            filtered_dirs.append(d)
-                    dirs[:] = filtered_dirs
-                
-                filtered_files = []
-                for f in files:
-                    # Get relative path from root_path
-                    rel_file_path = os.path.relpath(os.path.join(root, f), path).replace('\\', '/')
-                    # Check if any pattern matches the filename or path
-                    if not any(fnmatch(f, pattern) or fnmatch(rel_file_path, pattern) for pattern in ignore_patterns):
-                        filtered_files.append(f)
-                files = filtered_files
-
-            if extensions:
-                files = [f for f in files if f.endswith(extensions)]
-
-            for file in files:
-                file_path = os.path.join(root, file)
-                if file_path not in processed_paths:
-                    all_files.append(file_path)
-
-    # Sort files to ensure consistent order
-    for file_path in sorted(all_files):
-        processed_paths.add(file_path)
-        if extract_sqlite and is_sqlite3_file(file_path):
-            try:
-                schema = get_sqlite_schema(file_path)
-                content = f"-- SQLite3 Database Schema\n{schema}"
-                if not stats_only:
-                    print_document(writer, file_path, content, line_numbers, root_path)
-                if stats_tracker:
-                    stats_tracker.add_file(file_path, content, processed=True)
-            except Exception as e:
-                warning_message = f"Warning: Error processing SQLite file {file_path}: {str(e)}"
+    if context is None:
+        context = RunContext()
+    seen = context.seen
+
+    def accepted_path(name, rel_dir, is_dir, gitignores):
+        """Apply every filter to a directory entry in a single pass.
+
+        Returns the entry's path below `path`, or None if it is filtered out.
+        Checks are ordered cheapest first: the name-only checks run before the
+        path is even built, and the .gitignore rules are only evaluated for
+        entries that survive all the other filters.
+        """
+        if (not include_hidden and name.startswith(".")) or (
+            not is_dir and ext_set is not None and not has_extension(name, ext_set)
+        ):
+            return None
+        rel_path = f"{rel_dir}/{name}" if rel_dir else name
+        if (
+            ignore_patterns is not None
+            and not (is_dir and ignore_files_only)
+            # Patterns match the entry name, or its path below `path` if they contain a "/"
+            and ignore_patterns.match(name, rel_path)
+        ) or (gitignores and matches_gitignores(rel_path, is_dir, gitignores)):
+            return None
+        return rel_path
+
+    def entry_sort_key(entry):
+        """Sort a directory listing so that a depth-first walk yields sorted paths.
+
+        A directory sorts as its name plus a separator, which is where the
+        paths of the files inside it fall among its siblings.
+        """
+        return entry.name + os.sep if entry.is_dir() else entry.name
+
+    def scan(directory, rel_dir, gitignores):
+        """List directory and return a stack frame for walk().
+
+        gitignores holds the (base, spec) of every .gitignore from the top of
+        the walk down to the parent of directory, innermost first. The frame
+        carries it with directory's own .gitignore pushed on.
+        """
+        if not ignore_gitignore:
+            spec = load_gitignore_spec(directory)
+            if spec is not None:
+                gitignores = ((rel_dir, spec),) + gitignores
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=entry_sort_key)
+        except OSError:
+            # Unreadable directories are skipped, matching os.walk()
+            entries = []
+        return iter(entries), rel_dir, gitignores
+
+    def walk(top):
+        """Yield the files below top in sorted order, pruning rejected entries as we go.
+
+        Directories are visited depth first from an explicit stack of
+        partially consumed listings, so deep trees can't hit the recursion limit.
+        """
+        stack = [scan(top, "", ())]
+        while stack:
+            entries, rel_dir, gitignores = stack[-1]
+            for entry in entries:
+                # DirEntry caches the file type, so this doesn't need another stat()
+                is_dir = entry.is_dir()
+                rel_path = accepted_path(entry.name, rel_dir, is_dir, gitignores)
+                if rel_path is None:
+                    continue
+                if is_dir:
+                    # Like os.walk(), don't descend into symlinked directories
+                    if not entry.is_symlink():
+                        # Descend now; the rest of this listing is resumed afterwards
+                        stack.append(scan(entry.path, rel_path, gitignores))
+                        break
+                else:
+                    yield entry.path
+            else:
+                stack.pop()
+
+    # A single stat() tells us whether path is a file or a directory
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        mode = 0
+    if stat.S_ISREG(mode):
+        candidates = [path]
+    elif stat.S_ISDIR(mode):
+        candidates = walk(path)
+    else:
+        candidates = []
+
+    def unseen(candidates):
+        """Yield the candidates that have not been processed yet."""
+        for file_path in candidates:
+            # Normalize so that e.g. "./dir/file" and "dir/file" count as the same
+            # file, and mark it as seen right away so it is only queued once
+            file_path = os.path.normpath(file_path)
+            if file_path not in seen:
+                seen.add(file_path)
+                yield file_path
+
+    # Large files can be streamed straight to the output, unless their full
+    # content is needed for line numbering or token counting
+    stream = not (line_numbers or stats_only or stats_tracker)
+
+    # Files are read concurrently, but emitted here in the walk's sorted order
+    # so the output and document indexes stay deterministic. Reading starts
+    # as soon as the walk finds the first file, rather than after it ends.
+    for file_path, content, error in read_files(
+        unseen(candidates), extract_sqlite, stream, max_file_size
+    ):
+        if error is not None:
+            warning_message = f"Warning: Error processing SQLite file {file_path}: {str(error)}"
+            click.echo(click.style(warning_message, fg="red"), err=True)
+            if stats_tracker:
+                stats_tracker.add_file(file_path, f"-- SQLite3 Database Schema Error: {str(error)}", processed=False)
+        elif content is TOO_LARGE:
+            warning_message = f"Warning: Skipping file {file_path} larger than {max_file_size} bytes"
+            click.echo(click.style(warning_message, fg="yellow"), err=True)
+            if stats_tracker:
+                stats_tracker.add_file(file_path, "", processed=False)
+        elif isinstance(content, StreamedFile):
+            stream_error = stream_document(writer, file_path, content, context.index, root_path)
+            context.index += 1
+            if stream_error is not None:
+                warning_message = f"Warning: Output of file {file_path} cut short: {stream_error}"
                 click.echo(click.style(warning_message, fg="red"), err=True)
-                if stats_tracker:
-                    stats_tracker.add_file(file_path, f"-- SQLite3 Database Schema Error: {str(e)}", processed=False)
-        elif is_binary_file(file_path):
-            # Always skip binary files silently
-            pass  # Don't track binary files in stats at all
-        else:
-            try:
-                with open(file_path, "r") as f:
-                    content = f.read()
-                    if not stats_only:
-                        print_document(writer, file_path, content, line_numbers, root_path)
-                    if stats_tracker:
-                        stats_tracker.add_file(file_path, content, processed=True)
-            except UnicodeDecodeError:
-                # Silently skip files with decode errors
-                pass  # Don't track files with decode errors in stats
+        elif content is not None:
+            if not stats_only:
+                print_document(writer, file_path, content, line_numbers, context.index, root_path)
+                context.index += 1
+            if stats_tracker:
+                stats_tracker.add_file(file_path, content, processed=True)
+        # Binary files and files with decode errors are skipped silently
+        # and not tracked in stats at all
 
 def read_paths_from_stdin(use_null_separator):
+    """Yield the paths piped to stdin as they arrive, rather than after EOF."""
     if sys.stdin.isatty():
         # No ready input from stdin, don't block for input
-        return []
+        return
 
-    stdin_content = sys.stdin.read()
     if use_null_separator:
-        paths = stdin_content.split("\0")
+        pending = ""
+        for chunk in iter(lambda: sys.stdin.read(STDIN_CHUNK_SIZE), ""):
+            # The last piece may be a path cut off mid-chunk, so hold it back
+            *paths, pending = (pending + chunk).split("\0")
+            yield from (p for p in paths if p)
+        if pending:
+            yield pending
     else:
-        paths = stdin_content.split()  # split on whitespace
-    return [p for p in paths if p]
+        for line in sys.stdin:
+            yield from line.split()  # split on whitespace
 
 @click.command()
 @click.argument("paths", nargs=-1, type=click.Path(exists=True))
@@ -495,6 +920,18 @@ def read_paths_from_stdin(use_null_separator):
     is_flag=True,
     help="Track token statistics for processed files and output a tree at the end",
 )
+@click.option(
+    "fast_stats",
+    "--fast-stats",
+    is_flag=True,
+    help="Like --stats, but estimate token counts from a sample of the files instead of counting them all",
+)
+@click.option(
+    "max_file_size",
+    "--max-file-size",
+    type=click.IntRange(min=0),
+    help="Skip files larger than this many bytes, with a warning",
+)
 @click.option(
     "cwd",
     "--cwd",
@@ -520,6 +957,8 @@ def cli(
     null,
     extract_sqlite,
     stats,
+    fast_stats,
+    max_file_size,
     cwd,
     no_ignore_default,
 ):
@@ -538,10 +977,10 @@ def cli(
         ...
         </documents>
     """
-    # Reset globals for pytest
-    global global_index, processed_paths
-    global_index = 1
-    processed_paths = set()
+    # Per-run state, threaded through process_path() for every path
+    context = RunContext()
+    # .gitignore files may have changed since the last invocation
+    load_gitignore_spec.cache_clear()
     
     # Set the working directory if specified
     original_cwd = os.getcwd()
@@ -567,15 +1006,20 @@ def cli(
         ]
         ignore_patterns = list(ignore_patterns) + default_patterns
         click.echo(click.style("Added default ignore patterns", fg="blue"), err=True)
+
+    # Compile all ignore patterns once instead of re-parsing them for every entry
+    compiled_ignore_patterns = compile_ignore_patterns(ignore_patterns)
+    ext_set = compile_extensions(extensions)
     
     # Initialize stats tracker if needed
+    stats = stats or fast_stats
     stats_tracker = None
     if stats:
         try:
             # If there are paths, use the first path as the target for relative paths in stats
             # If cwd is set, paths are relative to that directory
             target_path = os.path.abspath(paths[0]) if paths else (os.getcwd() if cwd else None)
-            stats_tracker = StatsTracker(target_path=target_path)
+            stats_tracker = StatsTracker(target_path=target_path, fast=fast_stats)
         except ImportError:
             click.echo(click.style("Warning: tiktoken package not found. Statistics feature disabled.", fg="yellow"), err=True)
             stats = False
@@ -583,63 +1027,83 @@ def cli(
     # Read paths from stdin if available
     stdin_paths = read_paths_from_stdin(use_null_separator=null)
 
-    # Combine paths from arguments and stdin
-    paths = [*paths, *stdin_paths]
+    # Combine paths from arguments and stdin. Stdin is consumed lazily, so
+    # only check up front that there is at least one path.
+    paths = itertools.chain(paths, stdin_paths)
+    first_path = next(paths, None)
 
-    writer = click.echo
     fp = None
     if output_file:
-        fp = open(output_file, "w", encoding="utf-8")
-        # Use a proper function instead of lambda to avoid lint warning
-        def writer(s):
-            print(s, file=fp)
+        # The file's own (large) buffer batches the writes, no need for another
+        fp = open(output_file, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE)
+        writer = fp.write
 
-    if len(paths) > 0:
-        # Only output XML document tags if not in stats-only mode
-        if not stats:
-            writer("<documents>")
-            
-        for path in paths:
-            # Convert path to be relative to the specified cwd if needed
-            effective_path = path
-            if not os.path.exists(effective_path):
-                raise click.BadArgumentUsage(f"Path does not exist: {effective_path}")
-            # Store the absolute path of the first argument as the root path
-            abs_path = os.path.abspath(effective_path)
-            root_path = abs_path
-            
-            process_path(
-                path,
-                extensions,
-                include_hidden,
-                ignore_files_only,
-                ignore_gitignore,
-                ignore_patterns,  # This now includes default patterns if ignore_default is True
-                writer,
-                line_numbers,
-                extract_sqlite,
-                stats_tracker,
-                root_path,
-                stats_only=stats,  # Pass the stats flag as stats_only parameter
-            )
-            
-        if not stats:
-            writer("</documents>")
+        def flush_output():
+            fp.close()
     else:
-        raise click.BadArgumentUsage("No paths provided")
+        # Accumulate output in memory and write it out in large chunks, rather
+        # than paying for a click.echo() call per line
+        stdout = click.get_text_stream("stdout")
+        buf = io.StringIO()
+
+        def flush_output():
+            stdout.write(buf.getvalue())
+            stdout.flush()
+            buf.seek(0)
+            buf.truncate()
 
-    # Print statistics if requested
-    if stats and stats_tracker:
-        # Use a proper function instead of lambda to avoid lint warning
-        if not output_file:
-            stats_output = click.echo
+        def writer(s):
+            buf.write(s)
+            if buf.tell() > OUTPUT_BUFFER_SIZE:
+                flush_output()
+
+    try:
+        if first_path is not None:
+            # Only output XML document tags if not in stats-only mode
+            if not stats:
+                writer("<documents>\n")
+                
+            for path in itertools.chain((first_path,), paths):
+                # Convert path to be relative to the specified cwd if needed
+                effective_path = path
+                if not os.path.exists(effective_path):
+                    raise click.BadArgumentUsage(f"Path does not exist: {effective_path}")
+                # Store the absolute path of the first argument as the root path
+                abs_path = os.path.abspath(effective_path)
+                root_path = abs_path
+                
+                process_path(
+                    path,
+                    ext_set,
+                    include_hidden,
+                    ignore_files_only,
+                    ignore_gitignore,
+                    compiled_ignore_patterns,  # This now includes default patterns if ignore_default is True
+                    writer,
+                    line_numbers,
+                    extract_sqlite,
+                    stats_tracker,
+                    root_path,
+                    stats_only=stats,  # Pass the stats flag as stats_only parameter
+                    context=context,
+                    max_file_size=max_file_size,
+                )
+                
+            if not stats:
+                writer("</documents>\n")
         else:
+            raise click.BadArgumentUsage("No paths provided")
+
+        # Print statistics if requested
+        if stats and stats_tracker:
+            # The tree is written line by line, so send it through the same
+            # buffered writer as the documents
             def stats_output(s):
-                print(s, file=fp)
-        stats_tracker.print_tree(stats_output)
-    
-    if fp:
-        fp.close()
+                writer(f"{s}\n")
+            stats_tracker.print_tree(stats_output)
+    finally:
+        # Write out whatever is still buffered, even if processing failed part way
+        flush_output()
         
     # Restore the original working directory if it was changed
     if cwd:
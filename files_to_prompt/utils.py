@@ -1,6 +1,79 @@
+import functools
+import os
 from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
 from pathspec.gitignore import GitIgnoreSpec
 
+# Number of directories whose compiled .gitignore (or lack of one) is cached
+GITIGNORE_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=GITIGNORE_CACHE_SIZE)
+def load_gitignore_spec(directory: str) -> Optional[GitIgnoreSpec]:
+    """
+    Load and compile the .gitignore file in the given directory.
+
+    Results are cached per directory, so each .gitignore file is read and
+    parsed at most once no matter how many entries are checked against it.
+    The cache is bounded, since a walk of a large tree looks up every
+    directory it visits. Call load_gitignore_spec.cache_clear() to pick up
+    changes on disk.
+
+    The directory is a plain string so that callers walking large trees don't
+    have to build a Path object for every directory they visit.
+
+    Parameters:
+      directory (str): The directory that may contain a .gitignore file.
+
+    Returns:
+      Optional[GitIgnoreSpec]: The compiled rules, or None if the directory has
+      no readable .gitignore file.
+    """
+    gitignore_file = os.path.join(directory, ".gitignore")
+    if not os.path.isfile(gitignore_file):
+        return None
+    try:
+        # Read nonempty lines (ignoring blank lines).
+        with open(gitignore_file, encoding="utf-8") as f:
+            lines: List[str] = [line.rstrip("\n") for line in f.read().splitlines() if line.strip()]
+    except Exception as e:
+        print(f"Could not read {gitignore_file}: {e}")
+        return None
+    return GitIgnoreSpec.from_lines(lines)
+
+
+def matches_gitignores(
+    rel_path: str, is_dir: bool, gitignores: Sequence[Tuple[str, GitIgnoreSpec]]
+) -> bool:
+    """
+    Check whether an entry is ignored by a stack of .gitignore specs.
+
+    This lets a top-down directory walk push the spec of each .gitignore it
+    finds and check entries against all of them, without walking back up the
+    tree for every entry the way allowed_by_gitignore() does.
+
+    Parameters:
+      rel_path (str): The entry's POSIX path relative to the top of the walk.
+      is_dir (bool): Whether the entry is a directory, so that directory-only
+        patterns such as "build/" apply to it.
+      gitignores: (base, spec) pairs, innermost first, where base is the path
+        of the directory holding that .gitignore relative to the top of the
+        walk ("" for the top itself).
+
+    Returns:
+      bool: True if the entry should be ignored.
+    """
+    if is_dir:
+        rel_path += "/"
+    for base, spec in gitignores:
+        # .gitignore patterns are relative to the directory they are in.
+        result = spec.check_file(rel_path[len(base) + 1:] if base else rel_path)
+        # Rules in deeper .gitignore files take precedence, so the innermost
+        # one with a matching rule decides.
+        if result.include is not None:
+            return result.include
+    return False
+
 
 def allowed_by_gitignore(root: Path, file_path: Path) -> bool:
     """
@@ -26,33 +99,20 @@ def allowed_by_gitignore(root: Path, file_path: Path) -> bool:
         raise ValueError(f"File {abs_file!r} is not under the root {abs_root!r}.")
 
     # Build a list of directories from the root to the file's directory.
-    directories = [abs_root]
+    directories: List[Path] = [abs_root]
     file_dir = abs_file.parent
     rel_dir = file_dir.relative_to(abs_root)
     for part in rel_dir.parts:
         directories.append(directories[-1] / part)
 
     # The decision will be updated by any matching .gitignore rule encountered.
-    decision = None
+    decision: Optional[bool] = None
 
     # Process each directory (from root to file's directory)
     for directory in directories:
-        gitignore_file = directory / ".gitignore"
-        if gitignore_file.is_file():
-            try:
-                # Read nonempty lines (ignoring blank lines).
-                lines = [
-                    line.rstrip("\n")
-                    for line in gitignore_file.read_text(encoding="utf-8").splitlines()
-                    if line.strip()
-                ]
-            except Exception as e:
-                print(f"Could not read {gitignore_file}: {e}")
-                continue
-
-            # Compile a GitIgnoreSpec for the rules in the current directory.
-            spec = GitIgnoreSpec.from_lines(lines)
-
+        # Reuse the compiled GitIgnoreSpec for the rules in the current directory.
+        spec = load_gitignore_spec(str(directory))
+        if spec is not None:
             # .gitignore patterns are relative to the directory they are in.
             # Compute the file path relative to this directory in POSIX format.
             rel_file = abs_file.relative_to(directory).as_posix()
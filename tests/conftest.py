@@ -0,0 +1,124 @@
+import functools
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from files_to_prompt.cli import cli
+
+# Repositories cloned by test_snapshots.py and the snapshots it writes; the
+# clones come with test suites of their own that must not be collected
+collect_ignore = ["test_repos", "snapshots"]
+
+# Directory trees that tests only read, so they can be built once per session.
+# Each maps file paths to their contents; tests chdir into base_tree / <name>.
+BASE_TREES = {
+    "basic": {
+        "test_dir/file1.txt": "Contents of file1",
+        "test_dir/file2.txt": "Contents of file2",
+    },
+    "hidden": {
+        "test_dir/.hidden.txt": "Contents of hidden file",
+    },
+    "gitignore": {
+        "test_dir/.gitignore": "ignored.txt",
+        "test_dir/ignored.txt": "This file should be ignored",
+        "test_dir/included.txt": "This file should be included",
+        "test_dir/nested_include/included2.txt": "This nested file should be included",
+        "test_dir/nested_ignore/.gitignore": "*",
+        "test_dir/nested_ignore/nested_ignore.txt": "This nested file should not be included",
+    },
+    "ignore_patterns": {
+        "test_dir/file_to_ignore.txt": "This file should be ignored due to ignore patterns",
+        "test_dir/file_to_include.txt": "This file should be included",
+        "test_dir/test_subdir/any_file.txt": "This entire subdirectory should be ignored due to ignore patterns",
+    },
+    "multiple_paths": {
+        "test_dir1/file1.txt": "Contents of file1",
+        "test_dir2/file2.txt": "Contents of file2",
+        "single_file.txt": "Contents of single file",
+    },
+    "extensions": {
+        "test_dir/one.txt": "This is one.txt",
+        "test_dir/one.py": "This is one.py",
+        "test_dir/two/two.txt": "This is two/two.txt",
+        "test_dir/two/two.py": "This is two/two.py",
+        "test_dir/three.md": "This is three.md",
+    },
+}
+
+
+def write_tree(root, files):
+    """Write a {relative path: contents} dict of files under root.
+
+    Contents may be str or bytes. Each parent directory is created once, and
+    files are written with os.open() and os.write() directly, skipping the
+    file objects open() would build for them.
+    """
+    parents = {(root / path).parent for path in files}
+    for parent in sorted(parents, key=lambda p: len(p.parts)):
+        parent.mkdir(parents=True, exist_ok=True)
+    for path, content in files.items():
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        fd = os.open(root / path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, content)
+        finally:
+            os.close(fd)
+
+
+@pytest.fixture
+def create_tree(tmp_path):
+    """Return a function that writes a {path: contents} dict under tmp_path.
+
+    For tests that need their own tree, rather than one of BASE_TREES.
+    """
+    return functools.partial(write_tree, tmp_path)
+
+
+@pytest.fixture(scope="session")
+def base_tree(tmp_path_factory):
+    """Build every tree in BASE_TREES once, each in its own directory.
+
+    The trees are shared by all tests, so tests must not modify them. Tests
+    that need to write files build their own with create_tree instead.
+    """
+    root = tmp_path_factory.mktemp("base")
+    for name, files in BASE_TREES.items():
+        write_tree(root / name, files)
+    return root
+
+
+@pytest.fixture(scope="module")
+def runner():
+    """A CliRunner shared by the tests in a module.
+
+    Its output mixes stderr into stdout; tests that check stderr on its own
+    make a CliRunner(mix_stderr=False) instead.
+    """
+    return CliRunner()
+
+
+@pytest.fixture(scope="session")
+def invoke_cached(base_tree):
+    """Run the CLI on a tree in BASE_TREES, once per distinct set of arguments.
+
+    Returns a function taking the tree name and a tuple of CLI arguments, which
+    returns the exit code and standard output of running the CLI from inside
+    that tree. Tests that only differ in what they assert about the same
+    output share a single run instead of each scanning the tree again.
+    """
+    runner = CliRunner(mix_stderr=False)
+
+    @functools.lru_cache(maxsize=None)
+    def invoke(tree, args):
+        cwd = os.getcwd()
+        os.chdir(base_tree / tree)
+        try:
+            result = runner.invoke(cli, list(args))
+        finally:
+            os.chdir(cwd)
+        return result.exit_code, result.output
+
+    return invoke
@@ -1,275 +1,467 @@
 import os
 import pytest
 import re
+import sqlite3
+import sys
 from click.testing import CliRunner
 from files_to_prompt.cli import cli
 
+DOCUMENT_PATH_RE = re.compile(r'<document path="([^"]+)"')
+
+DOCUMENT_RE = re.compile(
+    r'<document path="(?P<path>[^"]+)" index="(?P<index>\d+)">(?P<body>.*?)</document>',
+    re.DOTALL,
+)
+
 def filenames_from_cxml(cxml_string):
     "Return set of filenames from document path attributes"
-    return set(re.findall(r'<document path="([^"]+)"', cxml_string))
-
-def test_basic_functionality(tmpdir):
-    runner = CliRunner()
+    return set(DOCUMENT_PATH_RE.findall(cxml_string))
+
+def parse_output(output):
+    "Return {path: (index, body)} for each document, failing on repeated paths"
+    docs = {}
+    for m in DOCUMENT_RE.finditer(output):
+        assert m.group("path") not in docs, f"{m.group('path')} output twice"
+        docs[m.group("path")] = (int(m.group("index")), m.group("body"))
+    return docs
+
+def test_basic_functionality(invoke_cached):
+    exit_code, output = invoke_cached("basic", ("test_dir",))
+    assert exit_code == 0
+    assert output.startswith("<documents>\n")
+    assert output.endswith("</documents>\n")
+    assert parse_output(output) == {
+        "test_dir/file1.txt": (1, "\nContents of file1\n"),
+        "test_dir/file2.txt": (2, "\nContents of file2\n"),
+    }
+
+@pytest.mark.parametrize(
+    "flags,expected",
+    [
+        ([], set()),
+        (["--include-hidden"], {"test_dir/.hidden.txt"}),
+    ],
+)
+def test_include_hidden(runner, base_tree, monkeypatch, flags, expected):
+    monkeypatch.chdir(base_tree / "hidden")
+
+    result = runner.invoke(cli, ["test_dir", *flags])
+    assert result.exit_code == 0
+    assert filenames_from_cxml(result.output) == expected
+    assert ("Contents of hidden file" in result.output) == bool(expected)
+
+def test_ignore_gitignore(runner, base_tree, monkeypatch):
+    monkeypatch.chdir(base_tree / "gitignore")
+
+    result = runner.invoke(cli, ["test_dir"])
+    assert result.exit_code == 0
+    filenames = filenames_from_cxml(result.output)
+
+    assert filenames == {
+        "test_dir/included.txt",
+        "test_dir/nested_include/included2.txt",
+    }
+
+    result2 = runner.invoke(cli, ["test_dir", "--ignore-gitignore"])
+    assert result2.exit_code == 0
+    filenames2 = filenames_from_cxml(result2.output)
+
+    assert filenames2 == {
+        "test_dir/included.txt",
+        "test_dir/ignored.txt",
+        "test_dir/nested_include/included2.txt",
+        "test_dir/nested_ignore/nested_ignore.txt",
+    }
+
+def test_multiple_paths(runner, base_tree, monkeypatch):
+    monkeypatch.chdir(base_tree / "multiple_paths")
+
+    result = runner.invoke(cli, ["test_dir1", "test_dir2", "single_file.txt"])
+    assert result.exit_code == 0
+    assert "<documents>" in result.output
+    assert result.output.endswith("</documents>\n")
+    assert parse_output(result.output) == {
+        "test_dir1/file1.txt": (1, "\nContents of file1\n"),
+        "test_dir2/file2.txt": (2, "\nContents of file2\n"),
+        "single_file.txt": (3, "\nContents of single file\n"),
+    }
+
+@pytest.mark.parametrize(
+    "flags,expected",
+    [
+        (["--ignore", "*.txt"], set()),
+        (
+            ["--ignore", "*subdir*"],
+            {"test_dir/file_to_ignore.txt", "test_dir/file_to_include.txt"},
+        ),
+        (
+            ["--ignore", "*subdir*", "--ignore-files-only"],
+            {
+                "test_dir/file_to_ignore.txt",
+                "test_dir/file_to_include.txt",
+                "test_dir/test_subdir/any_file.txt",
+            },
+        ),
+    ],
+)
+def test_ignore_patterns(runner, base_tree, monkeypatch, flags, expected):
+    monkeypatch.chdir(base_tree / "ignore_patterns")
+
+    result = runner.invoke(cli, ["test_dir", *flags])
+    assert result.exit_code == 0
+    assert filenames_from_cxml(result.output) == expected
+
+def test_specific_extensions(runner, base_tree, monkeypatch):
+    monkeypatch.chdir(base_tree / "extensions")
+
+    result = runner.invoke(cli, ["test_dir", "-e", "py", "-e", "md"])
+    assert result.exit_code == 0
+    assert ".txt" not in result.output
+    assert set(parse_output(result.output)) == {
+        "test_dir/one.py",
+        "test_dir/two/two.py",
+        "test_dir/three.md",
+    }
+
+def test_binary_file_warning(tmpdir, create_tree):
+    runner = CliRunner(mix_stderr=False)
     with tmpdir.as_cwd():
-        os.makedirs("test_dir")
-        with open("test_dir/file1.txt", "w") as f:
-            f.write("Contents of file1")
-        with open("test_dir/file2.txt", "w") as f:
-            f.write("Contents of file2")
+        create_tree({
+            "test_dir/binary_file.bin": b"\xff",
+            "test_dir/text_file.txt": "This is a text file",
+        })
 
         result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        assert "<documents>" in result.output
-        assert '<document path="test_dir/file1.txt" index="1">' in result.output
-        assert "Contents of file1" in result.output
-        assert '<document path="test_dir/file2.txt" index="2">' in result.output
-        assert "Contents of file2" in result.output
-        assert "</documents>" in result.output
-
-def test_include_hidden(tmpdir):
-    runner = CliRunner()
+
+        stdout = result.stdout
+        stderr = result.stderr
+
+        assert parse_output(stdout) == {
+            "test_dir/text_file.txt": (1, "\nThis is a text file\n"),
+        }
+        assert "test_dir/binary_file.bin" not in stdout
+        # Binary files are skipped silently
+        assert "test_dir/binary_file.bin" not in stderr
+
+def test_unreadable_file_skipped(runner, tmpdir, create_tree):
     with tmpdir.as_cwd():
-        os.makedirs("test_dir")
-        with open("test_dir/.hidden.txt", "w") as f:
-            f.write("Contents of hidden file")
+        create_tree({"test_dir/file1.txt": "Contents of file1"})
+        os.symlink("nonexistent.txt", "test_dir/broken.txt")
 
         result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        assert "test_dir/.hidden.txt" not in result.output
-
-        result = runner.invoke(cli, ["test_dir", "--include-hidden"])
-        assert result.exit_code == 0
-        assert '<document path="test_dir/.hidden.txt"' in result.output
-        assert "Contents of hidden file" in result.output
+        assert parse_output(result.output) == {
+            "test_dir/file1.txt": (1, "\nContents of file1\n"),
+        }
 
-def test_ignore_gitignore(tmpdir):
-    runner = CliRunner()
+def test_output_option(invoke_cached, base_tree, tmp_path, monkeypatch):
+    runner = CliRunner(mix_stderr=False)
+    monkeypatch.chdir(base_tree / "basic")
+    output_file = tmp_path / "output.txt"
+    result = runner.invoke(cli, ["test_dir", "-o", str(output_file)])
+    assert result.exit_code == 0
+    assert not result.stdout
+    content = output_file.read_text()
+    # Writing to a file produces exactly what would have gone to stdout
+    assert content == invoke_cached("basic", ("test_dir",))[1]
+    assert set(parse_output(content)) == {"test_dir/file1.txt", "test_dir/file2.txt"}
+
+def test_line_numbers(runner, tmpdir, create_tree):
     with tmpdir.as_cwd():
-        os.makedirs("test_dir")
-        os.makedirs("test_dir/nested_include")
-        os.makedirs("test_dir/nested_ignore")
-        with open("test_dir/.gitignore", "w") as f:
-            f.write("ignored.txt")
-        with open("test_dir/ignored.txt", "w") as f:
-            f.write("This file should be ignored")
-        with open("test_dir/included.txt", "w") as f:
-            f.write("This file should be included")
-        with open("test_dir/nested_include/included2.txt", "w") as f:
-            f.write("This nested file should be included")
-        with open("test_dir/nested_ignore/.gitignore", "w") as f:
-            f.write("*")
-        with open("test_dir/nested_ignore/nested_ignore.txt", "w") as f:
-            f.write("This nested file should not be included")
+        test_content = "First line\nSecond line\nThird line\nFourth line\n"
+        create_tree({"test_dir/multiline.txt": test_content})
 
         result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        filenames = filenames_from_cxml(result.output)
+        _, body = parse_output(result.output)["test_dir/multiline.txt"]
+        assert body == "\n" + test_content + "\n"
+
+        result = runner.invoke(cli, ["test_dir", "-n"])
+        assert result.exit_code == 0
+        _, body = parse_output(result.output)["test_dir/multiline.txt"]
+        assert "1  First line" in body
+        assert "2  Second line" in body
+        assert "3  Third line" in body
+        assert "4  Fourth line" in body
+
+@pytest.mark.parametrize(
+    "args,stdin",
+    [
+        ([], "test_dir1/file1.txt\ntest_dir2/file2.txt"),
+        (["test_dir1"], "test_dir2/file2.txt"),
+    ],
+)
+def test_paths_from_stdin_and_arguments(runner, base_tree, monkeypatch, args, stdin):
+    monkeypatch.chdir(base_tree / "multiple_paths")
+
+    result = runner.invoke(cli, args, input=stdin)
+    assert result.exit_code == 0
+    assert parse_output(result.output) == {
+        "test_dir1/file1.txt": (1, "\nContents of file1\n"),
+        "test_dir2/file2.txt": (2, "\nContents of file2\n"),
+    }
+
+def test_reading_null_separated_paths_from_stdin(runner, tmpdir, create_tree):
+    with tmpdir.as_cwd():
+        create_tree({
+            "test_dir/file one.txt": "Contents of file one",
+            "test_dir/file2.txt": "Contents of file2",
+        })
 
-        assert filenames == {
-            "test_dir/included.txt",
-            "test_dir/nested_include/included2.txt",
+        result = runner.invoke(
+            cli, ["--null"], input="test_dir/file one.txt\0test_dir/file2.txt\0"
+        )
+        assert result.exit_code == 0
+        assert parse_output(result.output) == {
+            "test_dir/file one.txt": (1, "\nContents of file one\n"),
+            "test_dir/file2.txt": (2, "\nContents of file2\n"),
         }
 
-        result2 = runner.invoke(cli, ["test_dir", "--ignore-gitignore"])
-        assert result2.exit_code == 0
-        filenames2 = filenames_from_cxml(result2.output)
+def test_duplicate_paths(runner, tmpdir, create_tree):
+    with tmpdir.as_cwd():
+        create_tree({
+            "test_dir/file1.txt": "File 1 contents",
+            "test_dir/subdir/file2.txt": "File 2 contents in subdir",
+        })
 
-        assert filenames2 == {
-            "test_dir/included.txt",
-            "test_dir/ignored.txt",
-            "test_dir/nested_include/included2.txt",
-            "test_dir/nested_ignore/nested_ignore.txt",
+        result = runner.invoke(cli, ["test_dir", "test_dir/subdir"])
+        assert result.exit_code == 0
+        # parse_output() fails if subdir/file2.txt is output twice
+        assert parse_output(result.output) == {
+            "test_dir/file1.txt": (1, "\nFile 1 contents\n"),
+            "test_dir/subdir/file2.txt": (2, "\nFile 2 contents in subdir\n"),
         }
 
-def test_multiple_paths(tmpdir):
-    runner = CliRunner()
+def test_duplicate_paths_normalized(runner, tmpdir, create_tree):
     with tmpdir.as_cwd():
-        os.makedirs("test_dir1")
-        with open("test_dir1/file1.txt", "w") as f:
-            f.write("Contents of file1")
-        os.makedirs("test_dir2")
-        with open("test_dir2/file2.txt", "w") as f:
-            f.write("Contents of file2")
-        with open("single_file.txt", "w") as f:
-            f.write("Contents of single file")
-
-        result = runner.invoke(cli, ["test_dir1", "test_dir2", "single_file.txt"])
+        create_tree({"test_dir/file1.txt": "File 1 contents"})
+
+        result = runner.invoke(cli, ["./test_dir", "test_dir", "test_dir/file1.txt"])
         assert result.exit_code == 0
-        assert "<documents>" in result.output
-        assert '<document path="test_dir1/file1.txt" index="1">' in result.output
-        assert "Contents of file1" in result.output
-        assert '<document path="test_dir2/file2.txt" index="2">' in result.output
-        assert "Contents of file2" in result.output
-        assert '<document path="single_file.txt" index="3">' in result.output
-        assert "Contents of single file" in result.output
-        assert "</documents>" in result.output
-
-def test_ignore_patterns(tmpdir):
-    runner = CliRunner()
+        assert parse_output(result.output) == {
+            "test_dir/file1.txt": (1, "\nFile 1 contents\n"),
+        }
+
+def test_extensions_normalized(runner, tmpdir, create_tree):
     with tmpdir.as_cwd():
-        os.makedirs("test_dir", exist_ok=True)
-        with open("test_dir/file_to_ignore.txt", "w") as f:
-            f.write("This file should be ignored due to ignore patterns")
-        with open("test_dir/file_to_include.txt", "w") as f:
-            f.write("This file should be included")
+        create_tree({
+            "test_dir/upper.PY": "This is upper.PY",
+            "test_dir/archive.tar.gz.txt": "This is archive.tar.gz.txt",
+            "test_dir/copy": "No extension at all",
+        })
 
-        result = runner.invoke(cli, ["test_dir", "--ignore", "*.txt"])
+        result = runner.invoke(cli, ["test_dir", "-e", ".py", "-e", "gz.txt"])
         assert result.exit_code == 0
-        assert "file_to_ignore.txt" not in result.output
-        assert "file_to_include.txt" not in result.output
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/upper.PY",
+            "test_dir/archive.tar.gz.txt",
+        }
+
+def test_nested_gitignore_rules(runner, tmpdir, create_tree):
+    with tmpdir.as_cwd():
+        create_tree({
+            "test_dir/.gitignore": "build/\n*.tmp\n",
+            "test_dir/build/output.txt": "Ignored by a directory-only pattern",
+            "test_dir/src/scratch.tmp": "Ignored by a pattern from the parent .gitignore",
+            "test_dir/src/keep/.gitignore": "!*.tmp\n",
+            "test_dir/src/keep/wanted.tmp": "Re-included by the nested .gitignore",
+            "test_dir/src/main.py": "print('hello')",
+        })
 
-        os.makedirs("test_dir/test_subdir", exist_ok=True)
-        with open("test_dir/test_subdir/any_file.txt", "w") as f:
-            f.write("This entire subdirectory should be ignored due to ignore patterns")
-        result = runner.invoke(cli, ["test_dir", "--ignore", "*subdir*"])
+        result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        assert "test_dir/test_subdir/any_file.txt" not in result.output
-        assert '<document path="test_dir/file_to_include.txt"' in result.output
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/src/main.py",
+            "test_dir/src/keep/wanted.tmp",
+        }
+
+def test_ignore_literal_patterns(runner, tmpdir, create_tree):
+    with tmpdir.as_cwd():
+        create_tree({
+            "test_dir/build/output.txt": "Ignored by directory name",
+            "test_dir/src/generated.txt": "Ignored by relative path",
+            "test_dir/src/main.txt": "Included",
+        })
 
         result = runner.invoke(
-            cli, ["test_dir", "--ignore", "*subdir*", "--ignore-files-only"]
+            cli, ["test_dir", "--ignore", "build", "--ignore", "src/generated.txt"]
         )
         assert result.exit_code == 0
-        assert '<document path="test_dir/test_subdir/any_file.txt"' in result.output
-
-def test_specific_extensions(tmpdir):
-    runner = CliRunner()
+        assert filenames_from_cxml(result.output) == {"test_dir/src/main.txt"}
+
+def test_fast_stats_estimates_unsampled_files(monkeypatch):
+    from files_to_prompt import cli as cli_module
+
+    class WordEncoding:
+        "Stand-in for a tiktoken encoding that counts one token per word"
+        def encode_ordinary_batch(self, texts, num_threads=1):
+            return [text.split() for text in texts]
+
+    monkeypatch.setattr(cli_module, "get_encoding", lambda name: WordEncoding())
+    tracker = cli_module.StatsTracker(fast=True)
+    for i in range(1, 11):
+        tracker.add_file(f"file{i}.txt", "word " * 10)
+    tracker.finalize()
+
+    # Files 1, 4 and 9 are sampled; the rest are estimated from their ratio
+    assert tracker.total_tokens == 100
+    assert {info["tokens"] for info in tracker.files.values()} == {10}
+
+def test_short_reads_not_treated_as_eof(runner, tmpdir, create_tree, monkeypatch):
+    from files_to_prompt import cli as cli_module
+
+    class ShortReads:
+        "File wrapper whose sized reads return at most 3 bytes, like some network filesystems"
+        def __init__(self, f):
+            self.f = f
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc_info):
+            self.f.close()
+        def read(self, size=-1):
+            return self.f.read(size if size < 0 else min(size, 3))
+        def fileno(self):
+            return self.f.fileno()
+
+    monkeypatch.setattr(cli_module, "open", lambda *args, **kwargs: ShortReads(open(*args, **kwargs)), raising=False)
     with tmpdir.as_cwd():
-        os.makedirs("test_dir/two")
-        with open("test_dir/one.txt", "w") as f:
-            f.write("This is one.txt")
-        with open("test_dir/one.py", "w") as f:
-            f.write("This is one.py")
-        with open("test_dir/two/two.txt", "w") as f:
-            f.write("This is two/two.txt")
-        with open("test_dir/two/two.py", "w") as f:
-            f.write("This is two/two.py")
-        with open("test_dir/three.md", "w") as f:
-            f.write("This is three.md")
-
-        result = runner.invoke(cli, ["test_dir", "-e", "py", "-e", "md"])
+        create_tree({"test_dir/file1.txt": "Contents of file1"})
+
+        result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        assert ".txt" not in result.output
-        assert '<document path="test_dir/one.py"' in result.output
-        assert '<document path="test_dir/two/two.py"' in result.output
-        assert '<document path="test_dir/three.md"' in result.output
+        assert parse_output(result.output) == {
+            "test_dir/file1.txt": (1, "\nContents of file1\n"),
+        }
 
-def test_binary_file_warning(tmpdir):
+def test_max_file_size(tmpdir, create_tree):
     runner = CliRunner(mix_stderr=False)
     with tmpdir.as_cwd():
-        os.makedirs("test_dir")
-        with open("test_dir/binary_file.bin", "wb") as f:
-            f.write(b"\xff")
-        with open("test_dir/text_file.txt", "w") as f:
-            f.write("This is a text file")
+        create_tree({
+            "test_dir/small.txt": "small",
+            "test_dir/large.txt": "x" * 100,
+        })
 
-        result = runner.invoke(cli, ["test_dir"])
+        result = runner.invoke(cli, ["test_dir", "--max-file-size", "50"])
         assert result.exit_code == 0
-
-        stdout = result.stdout
-        stderr = result.stderr
-
-        assert '<document path="test_dir/text_file.txt"' in stdout
-        assert "This is a text file" in stdout
-        assert "test_dir/binary_file.bin" not in stdout
+        assert filenames_from_cxml(result.stdout) == {"test_dir/small.txt"}
         assert (
-            "Warning: Skipping file test_dir/binary_file.bin due to UnicodeDecodeError"
-            in stderr
+            "Warning: Skipping file test_dir/large.txt larger than 50 bytes"
+            in result.stderr
         )
 
-def test_output_option(tmpdir):
-    runner = CliRunner()
+def test_large_file_streamed(runner, tmpdir, create_tree):
+    from files_to_prompt.cli import PROBE_SIZE, STREAM_CHUNK_SIZE
+
+    # The "é" straddles the end of the first chunk read after the probe
+    content = "a" * (PROBE_SIZE + STREAM_CHUNK_SIZE - 1) + "é\nlast line"
     with tmpdir.as_cwd():
-        os.makedirs("test_dir")
-        with open("test_dir/file1.txt", "w") as f:
-            f.write("Contents of file1.txt")
-        with open("test_dir/file2.txt", "w") as f:
-            f.write("Contents of file2.txt")
-        output_file = "output.txt"
-        result = runner.invoke(cli, ["test_dir", "-o", output_file])
+        create_tree({
+            "test_dir/large.txt": content,
+            "test_dir/small.txt": "small",
+        })
+
+        result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        assert not result.output
-        with open(output_file, "r") as f:
-            content = f.read()
-            assert "<documents>" in content
-            assert '<document path="test_dir/file1.txt" index="1">' in content
-            assert "Contents of file1.txt" in content
-            assert '<document path="test_dir/file2.txt" index="2">' in content
-            assert "Contents of file2.txt" in content
-            assert "</documents>" in content
-
-def test_line_numbers(tmpdir):
-    runner = CliRunner()
+        assert parse_output(result.output) == {
+            "test_dir/large.txt": (1, f"\n{content}\n"),
+            "test_dir/small.txt": (2, "\nsmall\n"),
+        }
+
+def test_large_file_cut_short(tmpdir, create_tree):
+    from files_to_prompt.cli import PROBE_SIZE, STREAM_CHUNK_SIZE
+
+    # Only turns out not to be UTF-8 once the probe and a chunk have been output
+    valid_size = PROBE_SIZE + STREAM_CHUNK_SIZE
+    runner = CliRunner(mix_stderr=False)
     with tmpdir.as_cwd():
-        os.makedirs("test_dir")
-        test_content = "First line\nSecond line\nThird line\nFourth line\n"
-        with open("test_dir/multiline.txt", "w") as f:
-            f.write(test_content)
+        create_tree({
+            "test_dir/large.txt": b"a" * valid_size + b"\xff",
+            "test_dir/small.txt": "small",
+        })
 
         result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        assert "1  First line" not in result.output
-        assert test_content in result.output
+        docs = parse_output(result.stdout)
+        assert docs["test_dir/large.txt"][1] == "\n" + "a" * valid_size + "\n"
+        assert docs["test_dir/small.txt"] == (2, "\nsmall\n")
+        assert "Warning: Output of file test_dir/large.txt cut short" in result.stderr
 
-        result = runner.invoke(cli, ["test_dir", "-n"])
+def test_extract_sqlite_schema(runner, tmpdir):
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        conn = sqlite3.connect("test_dir/data.db")
+        conn.executescript("""
+            CREATE TABLE t(a int, b text);
+            CREATE VIEW v AS SELECT a FROM t;
+            CREATE INDEX i ON t(b);
+        """)
+        conn.close()
+
+        result = runner.invoke(cli, ["test_dir", "--extract-sqlite"])
         assert result.exit_code == 0
-        assert "1  First line" in result.output
-        assert "2  Second line" in result.output
-        assert "3  Third line" in result.output
-        assert "4  Fourth line" in result.output
+        assert parse_output(result.output)["test_dir/data.db"][1] == (
+            "\n-- SQLite3 Database Schema\n"
+            "-- Tables\n"
+            "CREATE TABLE t(a int, b text);\n"
+            "\n-- Views\n"
+            "CREATE VIEW v AS SELECT a FROM t;\n"
+            "\n-- Indexes\n"
+            "CREATE INDEX i ON t(b);\n"
+        )
 
-def test_reading_paths_from_stdin(tmpdir):
-    runner = CliRunner()
+def test_extract_sqlite_schema_from_wal(runner, tmpdir):
     with tmpdir.as_cwd():
-        os.makedirs("test_dir1")
-        os.makedirs("test_dir2")
-        with open("test_dir1/file1.txt", "w") as f:
-            f.write("Contents of file1")
-        with open("test_dir2/file2.txt", "w") as f:
-            f.write("Contents of file2")
-
-        result = runner.invoke(cli, input="test_dir1/file1.txt\ntest_dir2/file2.txt")
+        os.makedirs("test_dir")
+        conn = sqlite3.connect("test_dir/data.db")
+        try:
+            # Keep the table in the write-ahead log: closing the connection
+            # or an automatic checkpoint would move it into the database
+            conn.execute("PRAGMA journal_mode = wal")
+            conn.execute("PRAGMA wal_autocheckpoint = 0")
+            conn.execute("CREATE TABLE t(a int)")
+            conn.commit()
+            assert os.path.getsize("test_dir/data.db-wal") > 0
+
+            result = runner.invoke(cli, ["test_dir/data.db", "--extract-sqlite"])
+        finally:
+            conn.close()
         assert result.exit_code == 0
-        assert '<document path="test_dir1/file1.txt" index="1">' in result.output
-        assert "Contents of file1" in result.output
-        assert '<document path="test_dir2/file2.txt" index="2">' in result.output
-        assert "Contents of file2" in result.output
+        assert "CREATE TABLE t(a int);" in result.output
 
-def test_paths_from_arguments_and_stdin(tmpdir):
-    runner = CliRunner()
+def test_deeply_nested_directories(runner, tmpdir, create_tree):
+    deep_file = "test_dir/" + "d/" * 300 + "deep.txt"
     with tmpdir.as_cwd():
-        os.makedirs("test_dir1")
-        os.makedirs("test_dir2")
-        with open("test_dir1/file1.txt", "w") as f:
-            f.write("Contents of file1")
-        with open("test_dir2/file2.txt", "w") as f:
-            f.write("Contents of file2")
-
-        result = runner.invoke(
-            cli,
-            args=["test_dir1"],
-            input="test_dir2/file2.txt",
-        )
+        create_tree({deep_file: "At the bottom"})
+
+        # Leave less room on the stack than the tree is deep, so a walker
+        # that used a stack frame per directory level would fail
+        depth = 0
+        frame = sys._getframe()
+        while frame is not None:
+            depth += 1
+            frame = frame.f_back
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(depth + 150)
+        try:
+            result = runner.invoke(cli, ["test_dir"])
+        finally:
+            sys.setrecursionlimit(limit)
         assert result.exit_code == 0
-        assert '<document path="test_dir1/file1.txt" index="1">' in result.output
-        assert "Contents of file1" in result.output
-        assert '<document path="test_dir2/file2.txt" index="2">' in result.output
-        assert "Contents of file2" in result.output
+        assert filenames_from_cxml(result.output) == {deep_file}
 
-def test_duplicate_paths(tmpdir):
-    runner = CliRunner()
+def test_output_sorted_by_path(runner, tmpdir, create_tree):
     with tmpdir.as_cwd():
-        os.makedirs("test_dir/subdir")
-        with open("test_dir/file1.txt", "w") as f:
-            f.write("File 1 contents")
-        with open("test_dir/subdir/file2.txt", "w") as f:
-            f.write("File 2 contents in subdir")
+        create_tree({
+            path: path
+            for path in ["test_dir/a/y.txt", "test_dir/a-b/x.txt", "test_dir/a.txt"]
+        })
 
-        result = runner.invoke(cli, ["test_dir", "test_dir/subdir"])
+        result = runner.invoke(cli, ["test_dir"])
         assert result.exit_code == 0
-        assert '<document path="test_dir/file1.txt" index="1">' in result.output
-        assert "File 1 contents" in result.output
-        assert '<document path="test_dir/subdir/file2.txt" index="2">' in result.output
-        assert "File 2 contents in subdir" in result.output
-
-        assert result.output.count('<document path="test_dir/subdir/file2.txt" index="2">') == 1
\ No newline at end of file
+        # "-" and "." sort before "/", so a-b/ and a.txt come before a/
+        assert DOCUMENT_PATH_RE.findall(result.output) == [
+            "test_dir/a-b/x.txt",
+            "test_dir/a.txt",
+            "test_dir/a/y.txt",
+        ]
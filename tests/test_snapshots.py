@@ -4,15 +4,43 @@ Snapshot tests for files-to-prompt CLI.
 Clones several repositories and runs files-to-prompt on them to verify output consistency.
 """
 
+import argparse
+import hashlib
+import json
+import os
+import re
 import sys
 import subprocess
 import pathlib
-from datetime import datetime
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from click.testing import CliRunner
 
 # Path definitions
 ROOT_DIR = pathlib.Path(__file__).parent.parent.resolve()
 SNAPSHOT_DIR = ROOT_DIR / "tests" / "snapshots"
 REPOS_DIR = ROOT_DIR / "tests" / "test_repos"
+# Tarballs of cloned repositories, kept across runs and checkouts
+CACHE_DIR = pathlib.Path(
+    os.environ.get("FILES_TO_PROMPT_TEST_CACHE", pathlib.Path.home() / ".cache" / "files-to-prompt-tests")
+)
+
+# Environment the commands run in; it doesn't change during a run
+_BASE_ENV = os.environ.copy()
+# Print every command before running it
+VERBOSE = bool(os.environ.get("SNAPSHOT_VERBOSE"))
+
+# One <document> block of the standard output. Files can contain
+# "</document>" themselves, so the body only ends at one that is followed by
+# the next document's header or by the end of the output.
+DOCUMENT_RE = re.compile(
+    rb'<document path="(?P<path>[^"]+)" index="\d+">\n(?P<body>.*?)\n</document>\n'
+    rb'(?=<document path="[^"]+" index="\d+">\n|</documents>\n?\Z)',
+    re.DOTALL,
+)
 
 # Repositories to test
 REPOS = {
@@ -28,31 +56,97 @@ def ensure_dir_exists(path):
         path.mkdir(parents=True)
     return path
 
+def remote_head(url):
+    """Return the commit the remote's HEAD points at, or None if it can't be reached."""
+    result = subprocess.run(["git", "ls-remote", url, "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return result.stdout.split()[0]
+
+def restore_from_cache(name, commit):
+    """Extract a cached tarball of the repository into REPOS_DIR.
+
+    Uses the tarball for the given commit, or the newest one for the repository
+    when the commit is unknown (e.g. offline). Returns whether one was found.
+    """
+    if commit:
+        candidates = [CACHE_DIR / f"{name}-{commit}.tar.gz"]
+    else:
+        # Match only a commit hash after the name, so "crawlee" doesn't pick
+        # up the tarballs of "crawlee-python"
+        candidates = sorted(CACHE_DIR.glob(f"{name}-[0-9a-f]*.tar.gz"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for cache_path in candidates:
+        if cache_path.exists():
+            print(f"Restoring {name} from {cache_path}...")
+            with tarfile.open(cache_path) as tar:
+                # Only trust the archive's own files, where Python supports it
+                extract_options = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+                tar.extractall(REPOS_DIR, **extract_options)
+            return True
+    return False
+
+def save_to_cache(name, repo_path, commit):
+    """Store a tarball of a fresh clone, keyed by its commit."""
+    ensure_dir_exists(CACHE_DIR)
+    cache_path = CACHE_DIR / f"{name}-{commit}.tar.gz"
+    # Write under a temporary name so a partial tarball is never picked up
+    partial_path = cache_path.with_name(cache_path.name + ".partial")
+    with tarfile.open(partial_path, "w:gz") as tar:
+        tar.add(repo_path, arcname=name)
+    partial_path.replace(cache_path)
+
 def clone_repositories():
-    """Clone the test repositories if they don't exist."""
+    """Clone the test repositories if they don't exist.
+
+    Clones are cached as tarballs in CACHE_DIR, keyed by the commit they were
+    cloned at, so later runs only ask the remote for its HEAD commit instead of
+    cloning again.
+    """
     ensure_dir_exists(REPOS_DIR)
     
+    missing = []
     for name, url in REPOS.items():
         repo_path = REPOS_DIR / name
         if not repo_path.exists():
             print(f"Cloning {name} from {url}...")
-            subprocess.run(["git", "clone", "--depth=1", url, str(repo_path)], check=True)
+            missing.append((name, url, repo_path))
         else:
             print(f"Repository {name} already exists, skipping clone.")
+    
+    def clone(repo):
+        name, url, repo_path = repo
+        if restore_from_cache(name, remote_head(url)):
+            return
+        subprocess.run(["git", "clone", "--depth=1", url, str(repo_path)], check=True)
+        # Key the tarball by the commit actually cloned; the remote may have
+        # moved on since ls-remote asked it for its HEAD
+        commit = subprocess.run(
+            ["git", "-C", str(repo_path), "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE, text=True, check=True,
+        ).stdout.strip()
+        save_to_cache(name, repo_path, commit)
+    
+    # Clones are bound by the network, so run them all at once
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            list(executor.map(clone, missing))
 
 def run_command(cmd, output_file=None):
     """Run a command and optionally save output to a file."""
-    print(f"Running: {' '.join(cmd)}")
+    if VERBOSE:
+        print(f"Running: {' '.join(cmd)}")
     
     if output_file:
-        with open(output_file, 'w') as f:
-            result = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE, text=True)
+        # The child writes straight to the file's descriptor; the parent never
+        # writes to it, so it needs neither text mode nor a buffer
+        with open(output_file, 'wb', buffering=0) as f:
+            result = subprocess.run(cmd, stdout=f.fileno(), stderr=subprocess.PIPE)
     else:
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     if result.returncode != 0:
         print(f"Command failed with exit code {result.returncode}")
-        print(f"stderr: {result.stderr}")
+        print(f"stderr: {result.stderr.decode(errors='replace')}")
         return False
     
     return True
@@ -60,36 +154,95 @@ def run_command(cmd, output_file=None):
 def run_command_with_env(cmd, output_file=None, env=None):
     """Run a command with custom environment variables and optionally save output to a file."""
     # Merge provided environment variables with current environment
-    current_env = subprocess.os.environ.copy()
-    if env:
-        current_env.update(env)
+    current_env = {**_BASE_ENV, **env} if env else _BASE_ENV
     
-    cmd_str = ' '.join(cmd)
-    env_str = ' '.join(f"{k}={v}" for k, v in env.items()) if env else ''
-    print(f"Running with env {env_str}: {cmd_str}")
+    if VERBOSE:
+        cmd_str = ' '.join(cmd)
+        env_str = ' '.join(f"{k}={v}" for k, v in env.items()) if env else ''
+        print(f"Running with env {env_str}: {cmd_str}")
     
     if output_file:
-        with open(output_file, 'w') as f:
-            result = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE, text=True, env=current_env)
+        # The child writes straight to the file's descriptor; the parent never
+        # writes to it, so it needs neither text mode nor a buffer
+        with open(output_file, 'wb', buffering=0) as f:
+            result = subprocess.run(cmd, stdout=f.fileno(), stderr=subprocess.PIPE, env=current_env)
     else:
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=current_env)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=current_env)
     
     if result.returncode != 0:
         print(f"Command failed with exit code {result.returncode}")
+        print(f"stderr: {result.stderr.decode(errors='replace')}")
+        return False
+    
+    return True
+
+def run_cli(args, output_file):
+    """Run files-to-prompt in this process and save its output to a file."""
+    from files_to_prompt.cli import cli
+
+    if VERBOSE:
+        print(f"Running in-process: files-to-prompt {' '.join(args)}")
+    result = CliRunner(mix_stderr=False).invoke(cli, args)
+    
+    if result.exit_code != 0:
+        print(f"Command failed with exit code {result.exit_code}")
         print(f"stderr: {result.stderr}")
+        if result.exception:
+            print(f"exception: {result.exception!r}")
         return False
     
+    # Save the bytes the CLI wrote rather than decoding and re-encoding them
+    pathlib.Path(output_file).write_bytes(result.stdout_bytes)
     return True
 
-def generate_snapshots():
-    """Generate snapshot files for each repository."""
+def write_manifest(output_file):
+    """Write a manifest of the documents in a standard snapshot next to it.
+
+    The manifest maps each document's path to a hash of its contents, so two
+    snapshots can be compared without reading or diffing the XML. Returns the
+    manifest's path.
+    """
+    output_file = pathlib.Path(output_file)
+    manifest = {
+        m.group("path").decode("utf-8"): hashlib.blake2b(m.group("body"), digest_size=16).hexdigest()
+        for m in DOCUMENT_RE.finditer(output_file.read_bytes())
+    }
+    manifest_file = output_file.with_suffix(".json")
+    manifest_file.write_text(json.dumps(manifest, indent=0, sort_keys=True), encoding="utf-8")
+    return manifest_file
+
+def compare_manifests(old_file, new_file):
+    """Compare two snapshot manifests.
+
+    Returns a dict with the sorted paths that were "added", "removed" and
+    "changed" between the old and the new snapshot.
+    """
+    old = json.loads(pathlib.Path(old_file).read_text(encoding="utf-8"))
+    new = json.loads(pathlib.Path(new_file).read_text(encoding="utf-8"))
+    return {
+        "added": sorted(new.keys() - old.keys()),
+        "removed": sorted(old.keys() - new.keys()),
+        "changed": sorted(path for path in old.keys() & new.keys() if old[path] != new[path]),
+    }
+
+def generate_snapshots(isolated=False):
+    """Generate snapshot files for each repository.
+
+    The CLI runs in this process, which saves starting an interpreter for
+    every snapshot. With isolated=True each run is a separate subprocess
+    instead, as a user would run it. Returns whether every run succeeded.
+    """
     ensure_dir_exists(SNAPSHOT_DIR)
     
     # Get the CLI script path
     cli_script = ROOT_DIR / "files_to_prompt" / "cli.py"
     
-    timestamp = datetime.now().strftime("%Y%m%d")
+    # Every repository's snapshots share the same names
+    timestamp = time.strftime("%Y%m%d")
+    standard_name = f"{timestamp}_standard.xml"
+    stats_name = f"{timestamp}_stats.txt"
     
+    jobs = []
     for repo_name in REPOS.keys():
         repo_path = REPOS_DIR / repo_name
         if not repo_path.exists():
@@ -100,26 +253,66 @@ def generate_snapshots():
         repo_snapshot_dir = ensure_dir_exists(SNAPSHOT_DIR / repo_name)
         
         # Run without stats flag
-        standard_output_file = repo_snapshot_dir / f"{timestamp}_standard.xml"
-        run_command([
-            sys.executable, str(cli_script), 
-            str(repo_path)
-        ], standard_output_file)
+        standard_output_file = repo_snapshot_dir / standard_name
+        jobs.append(([str(repo_path)], standard_output_file))
         
         # Run with stats flag
-        stats_output_file = repo_snapshot_dir / f"{timestamp}_stats.txt"
+        stats_output_file = repo_snapshot_dir / stats_name
         
-        run_command([
-            sys.executable, str(cli_script), 
-            "--stats", 
-            str(repo_path)
-        ], stats_output_file)
+        jobs.append((["--stats", str(repo_path)], stats_output_file))
+    
+    if not isolated:
+        # CliRunner swaps sys.stdout for each run, so these can't overlap
+        results = [run_cli(args, output_file) for args, output_file in jobs]
+    elif jobs:
+        # Every run is its own CLI subprocess, so the threads only wait on them
+        # and all runs proceed in parallel
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            results = list(executor.map(
+                lambda job: run_command([sys.executable, str(cli_script), *job[0]], job[1]),
+                jobs,
+            ))
+    else:
+        results = []
+    
+    for _, output_file in jobs:
+        if output_file.suffix == ".xml" and output_file.exists():
+            write_manifest(output_file)
+    return all(results)
+
+@pytest.mark.slow
+def test_snapshots():
+    """Clone the test repositories and snapshot files-to-prompt's output on each."""
+    clone_repositories()
+    assert generate_snapshots()
 
 
 def main():
     """Main function to run the snapshot tests."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--isolated",
+        action="store_true",
+        help="Run the CLI in a subprocess for every snapshot instead of in-process",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Compare two snapshot manifests instead of generating snapshots",
+    )
+    args = parser.parse_args()
+    # Run as a script, only tests/ is on the path; import the CLI from this
+    # checkout rather than any installed copy
+    sys.path.insert(0, str(ROOT_DIR))
+    if args.compare:
+        differences = compare_manifests(*args.compare)
+        for kind, paths in differences.items():
+            for path in paths:
+                print(f"{kind}: {path}")
+        sys.exit(1 if any(differences.values()) else 0)
     # Generate snapshots
-    generate_snapshots()
+    generate_snapshots(isolated=args.isolated)
     print(f"Snapshot tests completed. Results saved in {SNAPSHOT_DIR}")
 
 if __name__ == "__main__":